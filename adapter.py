@@ -1,17 +1,16 @@
-import json
+import asyncio
 import time
-import uuid
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 import os
 import logging
+from contextlib import aclosing, asynccontextmanager
 
 import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, ConfigDict, Field
 
-app = FastAPI(title="BP PoC Adapter", version="1.0.3")
-
 # -----------------------------
 # Config
 # -----------------------------
@@ -29,18 +28,46 @@ logger = logging.getLogger("uvicorn.error")
 
 
 # -----------------------------
-# Models
+# Upstream HTTP client (shared across requests so keep-alive pooling works)
 # -----------------------------
-class ChatMessage(BaseModel):
-    model_config = ConfigDict(extra="allow")
-    role: str
-    content: Any
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_running_loop()
+    logger.info(f"Event loop: {type(loop).__module__}.{type(loop).__name__}")
+    app.state.http = httpx.AsyncClient(
+        # Concurrent requests multiplex over one connection; falls back to HTTP/1.1
+        # if Lili does not negotiate h2.
+        http2=True,
+        timeout=LILI_TIMEOUT_SECONDS,
+        limits=httpx.Limits(
+            max_keepalive_connections=64,
+            max_connections=128,
+            keepalive_expiry=30.0,
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(
+    title="BP PoC Adapter",
+    version="1.0.3",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
+# -----------------------------
+# Models
+# -----------------------------
 class ChatCompletionsRequest(BaseModel):
     model_config = ConfigDict(extra="allow")
     model: str = "lili-workflow"
-    messages: List[ChatMessage] = Field(min_length=1)
+    # Kept as plain dicts: only the last user turn is read, so validating every
+    # replayed history entry as a model would be wasted work on each request.
+    messages: List[Dict[str, Any]] = Field(min_length=1)
     stream: bool = False
     user: Optional[str] = None
 
@@ -62,34 +89,117 @@ def _extract_text_from_content(content: Any) -> str:
     if isinstance(content, dict):
         for k in ("text", "content", "value", "message"):
             v = content.get(k)
-            if isinstance(v, str) and v.strip():
-                return v.strip()
+            if isinstance(v, str):
+                v = v.strip()
+                if v:
+                    return v
         return ""
     if isinstance(content, list):
         parts: List[str] = []
         for item in content:
-            if isinstance(item, str) and item.strip():
-                parts.append(item.strip())
-            elif isinstance(item, dict):
-                v = item.get("text") or item.get("content") or item.get("value")
-                if isinstance(v, str) and v.strip():
-                    parts.append(v.strip())
-        return "\n".join(parts).strip()
+            if isinstance(item, dict):
+                item = item.get("text") or item.get("content") or item.get("value")
+            if isinstance(item, str):
+                item = item.strip()
+                if item:
+                    parts.append(item)
+        # parts are already stripped and non-empty, so the join needs no strip
+        return "\n".join(parts)
     return str(content).strip()
 
 
-def last_user_message(messages: List[ChatMessage]) -> str:
-    for m in reversed(messages):
-        if (m.role or "").lower() == "user":
-            txt = _extract_text_from_content(m.content)
+def last_user_message(messages: List[Dict[str, Any]]) -> str:
+    # Scan from the tail: clients replay the whole history, the answer is near the end.
+    for i in range(len(messages) - 1, -1, -1):
+        m = messages[i]
+        role = m.get("role")
+        if role == "user" or (isinstance(role, str) and role.lower() == "user"):
+            txt = _extract_text_from_content(m.get("content"))
             if txt:
                 return txt
     return ""
 
 
+def _new_id() -> str:
+    # Random 128-bit hex id; callers only need an opaque string, not a UUID object.
+    return os.urandom(16).hex()
+
+
+# Keep proxies in front of the adapter (Railway's edge, Nginx, Cloudflare) from
+# caching or buffering the event stream into one chunk.
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+# Fixed tails of a chat.completion.chunk event, following the "delta" value.
+_SSE_CHUNK_TAIL = b',"finish_reason":null}]}\n\n'
+_SSE_STOP_TAIL = b',"finish_reason":"stop"}]}\n\n'
+_SSE_DONE = b"data: [DONE]\n\n"
+
+
+def _sse_chunk_prefix(stream_id: str, created: int, model: str) -> bytes:
+    """
+    Encodes everything of a chat.completion.chunk SSE event up to the "delta"
+    value once per stream, so each chunk only serializes its own delta.
+    orjson always emits UTF-8, so no ensure_ascii escaping is needed.
+    """
+    return (
+        b'data: {"id":' + orjson.dumps(stream_id)
+        + b',"object":"chat.completion.chunk","created":' + orjson.dumps(created)
+        + b',"model":' + orjson.dumps(model)
+        + b',"choices":[{"index":0,"delta":'
+    )
+
+
+# Backpressure / idle handling for proxied streams
+_SSE_QUEUE_SIZE = 16
+_SSE_KEEPALIVE_SECONDS = 15.0
+_SSE_KEEPALIVE = b": keepalive\n\n"
+_SSE_END = object()
+
+
+async def _bounded_sse(events: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Runs `events` in a producer task behind a bounded queue: when the client
+    reads slowly the producer blocks on put() instead of buffering the whole
+    reply, and while the upstream is quiet an SSE comment is sent every
+    _SSE_KEEPALIVE_SECONDS so idle proxies don't drop the connection.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_SSE_QUEUE_SIZE)
+
+    async def produce() -> None:
+        try:
+            async with aclosing(events):
+                async for chunk in events:
+                    await queue.put(chunk)
+        except Exception as exc:
+            await queue.put(exc)
+        else:
+            await queue.put(_SSE_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), _SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield _SSE_KEEPALIVE
+                continue
+            if item is _SSE_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Client went away (or we're done): stop reading from Lili.
+        producer.cancel()
+
+
 def _empty_chat_completion(model: str) -> Dict[str, Any]:
     created = int(time.time())
-    stream_id = f"chatcmpl-{uuid.uuid4().hex}"
+    stream_id = f"chatcmpl-{_new_id()}"
     return {
         "id": stream_id,
         "object": "chat.completion",
@@ -105,6 +215,32 @@ def _empty_chat_completion(model: str) -> Dict[str, Any]:
     }
 
 
+async def _fallback_reply(client: httpx.AsyncClient, payload: Dict[str, Any]) -> str:
+    """
+    Non-streaming Lili call used when the streaming attempt produced no tokens.
+    Only the reply text is returned, so the upstream response body and parsed
+    JSON are released before the caller starts writing to a (possibly slow) client.
+    """
+    fallback_payload = dict(payload)
+    fallback_payload["stream"] = False
+
+    try:
+        r2 = await client.post(LILI_ENDPOINT, json=fallback_payload)
+    except httpx.RequestError:
+        return ""
+
+    if r2.status_code >= 400:
+        return ""
+    try:
+        d2 = orjson.loads(r2.content)
+    except orjson.JSONDecodeError:
+        return ""
+    if not isinstance(d2, dict):
+        return ""
+    text = d2.get("message") or d2.get("error") or ""
+    return text.strip() if isinstance(text, str) else ""
+
+
 # -----------------------------
 # Exception logging (keeps Railway logs useful)
 # -----------------------------
@@ -120,7 +256,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         logger.error(
             f"HTTPException {exc.status_code} on {request.url.path} detail={exc.detail} (could not read body)"
         )
-    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+    return ORJSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
 
 
 # -----------------------------
@@ -128,49 +264,29 @@ async def http_exception_handler(request: Request, exc: HTTPException):
 # -----------------------------
 @app.post("/v1/chat/completions")
 async def chat_completions(body: ChatCompletionsRequest):
-    print("BP request stream =", body.stream)
+    logger.debug(f"BP request stream = {body.stream}")
 
-    user_text = last_user_message(body.messages).strip()
+    # already stripped by _extract_text_from_content
+    user_text = last_user_message(body.messages)
 
     
     if not user_text:
         if not body.stream:
-            return JSONResponse(_empty_chat_completion(body.model))
-
-        async def empty_sse():
-            created = int(time.time())
-            stream_id = f"chatcmpl-{uuid.uuid4().hex}"
-
-            init_event = {
-                "id": stream_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": body.model,
-                "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}],
-            }
-            yield f"data: {json.dumps(init_event, ensure_ascii=False)}\n\n"
-
-            final_event = {
-                "id": stream_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": body.model,
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
-            }
-            yield f"data: {json.dumps(final_event, ensure_ascii=False)}\n\n"
-            yield "data: [DONE]\n\n"
+            return ORJSONResponse(_empty_chat_completion(body.model))
+
+        async def empty_sse() -> AsyncIterator[bytes]:
+            prefix = _sse_chunk_prefix(f"chatcmpl-{_new_id()}", int(time.time()), body.model)
+            yield prefix + b'{"role":"assistant"}' + _SSE_CHUNK_TAIL
+            yield prefix + b"{}" + _SSE_STOP_TAIL
+            yield _SSE_DONE
 
         return StreamingResponse(
             empty_sse(),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
-            },
+            headers=_SSE_HEADERS,
         )
 
-    sender_id = (body.user or str(uuid.uuid4())).strip()
+    sender_id = (body.user or _new_id()).strip()
 
     payload: Dict[str, Any] = {
         "workflow_id": str(LILI_WORKFLOW_ID),
@@ -181,119 +297,81 @@ async def chat_completions(body: ChatCompletionsRequest):
     }
 
     created = int(time.time())
-    stream_id = f"chatcmpl-{uuid.uuid4().hex}"
+    stream_id = f"chatcmpl-{_new_id()}"
+    prefix = _sse_chunk_prefix(stream_id, created, body.model)
 
     # -----------------------------
     # Streaming response (proxy + fallback)
     # -----------------------------
-    async def sse_proxy():
+    async def sse_proxy() -> AsyncIterator[bytes]:
         # 1) role chunk
-        init_event = {
-            "id": stream_id,
-            "object": "chat.completion.chunk",
-            "created": created,
-            "model": body.model,
-            "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}],
-        }
-        yield f"data: {json.dumps(init_event, ensure_ascii=False)}\n\n"
+        yield prefix + b'{"role":"assistant"}' + _SSE_CHUNK_TAIL
 
         sent_any_content = False
+        client: httpx.AsyncClient = app.state.http
 
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", LILI_ENDPOINT, json=payload) as resp:
-                if resp.status_code >= 400:
-                    err_text = await resp.aread()
-                    raise HTTPException(
-                        status_code=502,
-                        detail=f"Lili error {resp.status_code}: {err_text.decode(errors='replace')}",
-                    )
-
-                # Attempt to parse streamed lines from Lili (SSE, NDJSON, or plain tokens)
-                async for line in resp.aiter_lines():
-                    if not line:
-                        continue
-
-                    # If Lili returns SSE like: "data: {...}"
-                    if line.startswith("data:"):
-                        line = line[len("data:"):].strip()
-
-                    # Common terminators
-                    if line in ("[DONE]", "DONE"):
-                        break
-
-                    token: Optional[str] = None
-
-                    # Try JSON decode first
-                    try:
-                        obj = json.loads(line)
-                        if isinstance(obj, dict):
-                            token = obj.get("delta") or obj.get("token") or obj.get("text") or obj.get("content")
-                        elif isinstance(obj, str):
-                            token = obj
-                    except Exception:
-                        # plain text token
-                        token = line
-
-                    if not token:
-                        continue
-
-                    event = {
-                        "id": stream_id,
-                        "object": "chat.completion.chunk",
-                        "created": created,
-                        "model": body.model,
-                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
-                    }
-                    sent_any_content = True
-                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        async with client.stream("POST", LILI_ENDPOINT, json=payload, timeout=None) as resp:
+            if resp.status_code >= 400:
+                err_text = await resp.aread()
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Lili error {resp.status_code}: {err_text.decode(errors='replace')}",
+                )
 
-        # Fallback: if Lili streaming produced no tokens, do a non-streaming call and emit one content chunk.
-        if not sent_any_content:
-            fallback_payload = dict(payload)
-            fallback_payload["stream"] = False
+            # Attempt to parse streamed lines from Lili (SSE, NDJSON, or plain tokens)
+            async for line in resp.aiter_lines():
+                if not line:
+                    continue
 
-            try:
-                async with httpx.AsyncClient(timeout=LILI_TIMEOUT_SECONDS) as c2:
-                    r2 = await c2.post(LILI_ENDPOINT, json=fallback_payload)
-            except httpx.RequestError:
-                r2 = None
+                # If Lili returns SSE like: "data: {...}"
+                if line.startswith("data:"):
+                    line = line[len("data:"):].strip()
 
-            assistant_text = ""
-            if r2 is not None and r2.status_code < 400:
+                # Common terminators
+                if line in ("[DONE]", "DONE"):
+                    break
+
+                token: Optional[str] = None
+
+                # Try JSON decode first
                 try:
-                    d2 = r2.json()
-                    assistant_text = (d2.get("message") or d2.get("error") or "").strip()
-                except Exception:
-                    assistant_text = ""
+                    obj = orjson.loads(line)
+                    if isinstance(obj, dict):
+                        token = obj.get("delta") or obj.get("token") or obj.get("text") or obj.get("content")
+                        # OpenAI-style chunks nest the text: {"delta": {"content": "..."}}
+                        if isinstance(token, dict):
+                            token = token.get("content")
+                        # Lili may ignore the stream flag and send its regular JSON reply;
+                        # forward its "message" now instead of re-requesting it in the fallback.
+                        if not token and isinstance(obj.get("message"), str):
+                            token = obj["message"]
+                    elif isinstance(obj, str):
+                        token = obj
+                except orjson.JSONDecodeError:
+                    # plain text token
+                    token = line
+
+                # Never forward empty or non-text deltas (role-only/usage chunks);
+                # clients render those as empty assistant bubbles.
+                if not token or not isinstance(token, str):
+                    continue
+
+                sent_any_content = True
+                yield prefix + orjson.dumps({"content": token}) + _SSE_CHUNK_TAIL
 
+        # Fallback: if Lili streaming produced no tokens, do a non-streaming call and emit one content chunk.
+        if not sent_any_content:
+            assistant_text = await _fallback_reply(client, payload)
             if assistant_text:
-                fallback_event = {
-                    "id": stream_id,
-                    "object": "chat.completion.chunk",
-                    "created": created,
-                    "model": body.model,
-                    "choices": [{"index": 0, "delta": {"content": assistant_text}, "finish_reason": None}],
-                }
-                yield f"data: {json.dumps(fallback_event, ensure_ascii=False)}\n\n"
+                yield prefix + orjson.dumps({"content": assistant_text}) + _SSE_CHUNK_TAIL
                 sent_any_content = True
 
         # 3) stop chunk + DONE
-        final_event = {
-            "id": stream_id,
-            "object": "chat.completion.chunk",
-            "created": created,
-            "model": body.model,
-            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
-        }
-        yield f"data: {json.dumps(final_event, ensure_ascii=False)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield prefix + b"{}" + _SSE_STOP_TAIL
+        yield _SSE_DONE
 
     return StreamingResponse(
-        sse_proxy(),
+        _bounded_sse(sse_proxy()),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
+        headers=_SSE_HEADERS,
     )
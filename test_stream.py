@@ -1,6 +1,5 @@
-import json
 import sys
-import requests
+import httpx
 
 url = "https://bp-poc-production.up.railway.app/v1/chat/completions"
 payload = {
@@ -8,11 +7,13 @@ payload = {
     "messages": [{"role": "user", "content": "Hello"}],
     "stream": True,
 }
+headers = {"Accept": "text/event-stream"}
 
-with requests.post(url, json=payload, stream=True, timeout=120) as r:
-    r.raise_for_status()
-    for raw in r.iter_lines(decode_unicode=True):
-        if not raw:
-            continue
-        print(raw)
-        sys.stdout.flush()
+with httpx.Client(timeout=120) as client:
+    with client.stream("POST", url, json=payload, headers=headers) as r:
+        r.raise_for_status()
+        for raw in r.iter_lines():
+            if not raw:
+                continue
+            print(raw)
+            sys.stdout.flush()